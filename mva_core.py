@@ -0,0 +1,194 @@
+"""
+Geometry parsing and Topsky formatting used by mva_parser
+Plain Python with full type annotations, so it can optionally be compiled
+with mypyc (mypyc mva_core.py) to speed up large conversions
+"""
+import re
+from functools import lru_cache
+from typing import List, Optional, Sequence, Set, Tuple
+
+# Coordinate list inside the double parentheses of POLYGON((...)) or bare ((...))
+WKT_RE = re.compile(r'\(\((.*?)\)\)', re.DOTALL)
+
+# Geometries whose "((" does not start within this many characters (after
+# leading whitespace) are skipped, long enough for prefixes like
+# "SRID=4326;GEOMETRYCOLLECTION Z (MULTIPOLYGON Z ((("
+WKT_PREFIX_LENGTH = 64
+
+# Number of distinct DMS strings kept around, adjacent polygons share vertices
+DMS_CACHE_SIZE = 1 << 17
+
+# Vertex as a pair of (latitude, longitude) DMS strings
+DmsPoint = Tuple[str, str]
+
+def parse_geometry(geometry_str: Optional[str]) -> List[List[float]]:
+    """
+    Parse WKT geometry string and extract coordinates
+    Format: POLYGON((lon1 lat1, lon2 lat2, ...))
+    The "((" must start within the first WKT_PREFIX_LENGTH characters after
+    leading whitespace, longer prefixes are not parsed
+    Returns a list of [lat, lon] pairs
+    """
+    if not geometry_str or not isinstance(geometry_str, str):
+        return []
+    
+    # Cheap check before the regex, WKT opens its coordinate list near the start
+    if geometry_str.lstrip().find('((', 0, WKT_PREFIX_LENGTH) < 0:
+        return []
+    
+    try:
+        match = WKT_RE.search(geometry_str)
+        if not match:
+            return []
+        coord_str = match.group(1)
+        
+        pairs = [pair.split() for pair in coord_str.split(',')]
+        coords: Optional[List[List[float]]] = None
+        if all(len(parts) == 2 for parts in pairs):
+            # Fast path: every pair is a plain "lon lat", convert all values in one pass
+            try:
+                it = map(float, [value for parts in pairs for value in parts])
+                coords = [[lat, lon] for lon, lat in zip(it, it)
+                          if -180 <= lon <= 180 and -90 <= lat <= 90]  # Basic validation
+            except ValueError:
+                coords = None
+        
+        if coords is None:
+            # Slow path: pairs with extra dimensions or invalid values
+            coords = []
+            for parts in pairs:
+                if len(parts) >= 2:
+                    try:
+                        lon = float(parts[0])
+                        lat = float(parts[1])
+                        if -180 <= lon <= 180 and -90 <= lat <= 90:  # Basic validation
+                            coords.append([lat, lon])
+                    except (ValueError, IndexError):
+                        continue
+        
+        # Need at least 3 points to form a polygon
+        if len(coords) < 3:
+            return []
+        
+        return coords
+    
+    except Exception as e:
+        print(f"Error parsing geometry: {e}")
+        return []
+
+def dms_components(decimal_deg: float) -> Tuple[bool, int, int, int]:
+    """
+    Split decimal degrees into whole degrees, minutes and rounded seconds
+    The exact value of the float is rounded to the nearest second once, with
+    integer math (halves round to even, like round())
+    Returns (is_negative, degrees, minutes, seconds)
+    """
+    is_negative = decimal_deg < 0
+    numerator, denominator = abs(decimal_deg).as_integer_ratio()
+    
+    # Round to nearest second, carries into minutes and degrees come for free
+    total_seconds, remainder = divmod(numerator * 3600, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and total_seconds % 2):
+        total_seconds += 1
+    degrees, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    
+    return is_negative, degrees, minutes, seconds
+
+@lru_cache(maxsize=DMS_CACHE_SIZE)
+def decimal_to_dms(decimal_deg: float, is_latitude: bool = True) -> str:
+    """
+    Convert decimal degrees to Topsky DMS format
+    Returns a string in the format "N/S/E/W DDD.MM.SS.000"
+    Results are cached, shared polygon vertices are only formatted once
+    """
+    is_negative, degrees, minutes, seconds = dms_components(decimal_deg)
+    
+    # Format direction prefix
+    if is_latitude:
+        prefix = 'S' if is_negative else 'N'
+    else:
+        prefix = 'W' if is_negative else 'E'
+    
+    # Format to exactly match the Topsky format (including leading zeros)
+    return f"{prefix}{degrees:03d}.{minutes:02d}.{seconds:02d}.000"
+
+def decimal_list_to_dms(values: Sequence[float], is_latitude: bool = True) -> List[str]:
+    """
+    Convert a sequence of decimal degrees to Topsky DMS format
+    Returns a list of strings in the format "N/S/E/W DDD.MM.SS.000"
+    """
+    return [decimal_to_dms(decimal_deg, is_latitude) for decimal_deg in values]
+
+def point_in_polygon(coords: List[List[float]], lat: float, lon: float) -> bool:
+    """
+    Check if a point lies inside a polygon with the even-odd ray casting rule
+    Input: List of [lat, lon] coordinates and the point's lat and lon
+    """
+    inside = False
+    lat1, lon1 = coords[-1]
+    for lat2, lon2 in coords:
+        # Count crossings of a ray from the point towards the east
+        if (lat2 > lat) != (lat1 > lat):
+            if lon < (lon1 - lon2) * (lat - lat2) / (lat1 - lat2) + lon2:
+                inside = not inside
+        lat1, lon1 = lat2, lon2
+    return inside
+
+def shoelace_centroid(coords: List[List[float]]) -> Optional[List[float]]:
+    """
+    Calculate the area centroid of a simple polygon with the shoelace formula
+    Input: List of [lat, lon] coordinates
+    Output: [lat, lon] of centroid, or None if the polygon has no area
+    """
+    # Work relative to the first vertex to keep the cross products precise
+    lat0, lon0 = coords[0]
+    lat1, lon1 = coords[-1][0] - lat0, coords[-1][1] - lon0
+    
+    area2 = 0.0  # Twice the signed area
+    lat_sum = 0.0
+    lon_sum = 0.0
+    for lat, lon in coords:
+        lat2, lon2 = lat - lat0, lon - lon0
+        cross = lon1 * lat2 - lon2 * lat1
+        area2 += cross
+        lat_sum += (lat1 + lat2) * cross
+        lon_sum += (lon1 + lon2) * cross
+        lat1, lon1 = lat2, lon2
+    
+    if area2 == 0:
+        return None
+    
+    return [lat0 + lat_sum / (3 * area2), lon0 + lon_sum / (3 * area2)]
+
+def polygon_line_entries(coords: List[List[float]], seen: Set[Tuple[DmsPoint, DmsPoint]]) -> List[str]:
+    """
+    Generate the LINE entries of one polygon
+    coords is a list of [lat, lon] coordinates
+    Edges already in seen (shared with an earlier polygon) are skipped,
+    new edges are added to it
+    Returns a list of newline-terminated entries
+    """
+    # WKT rings repeat the first vertex at the end, the closing edge below
+    # already connects back to it
+    if coords[0] == coords[-1]:
+        coords = coords[:-1]
+    
+    # Format all vertices in Topsky format once per polygon
+    lat_strs = decimal_list_to_dms([c[0] for c in coords], is_latitude=True)
+    lon_strs = decimal_list_to_dms([c[1] for c in coords], is_latitude=False)
+    
+    # Connect each point to the next, including last to first to close the polygon
+    entries: List[str] = []
+    points = list(zip(lat_strs, lon_strs))
+    for start, end in zip(points, points[1:] + points[:1]):
+        # Neighbouring polygons run along a shared edge in opposite directions
+        edge = (start, end) if start <= end else (end, start)
+        if edge in seen:
+            continue
+        seen.add(edge)
+        
+        # Create LINE entry
+        entries.append(f"LINE:{start[0]}:{start[1]}:{end[0]}:{end[1]}\n")
+    
+    return entries
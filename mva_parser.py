@@ -1,8 +1,15 @@
 import csv
-import re
 import os
 import argparse
-import math
+from operator import itemgetter
+
+from mva_core import (
+    parse_geometry,
+    decimal_to_dms,
+    point_in_polygon,
+    shoelace_centroid,
+    polygon_line_entries,
+)
 
 if hasattr(argparse, 'BooleanOptionalAction'):
     boolean_action = argparse.BooleanOptionalAction
@@ -32,100 +39,62 @@ except ImportError:
     print("Shapely library not found. Falling back to basic centroid calculation.")
     SHAPELY_AVAILABLE = False
 
-def read_csv_file(file_path):
+# Output file buffer size
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Head written before each map, filled in with "Summer" or "Winter"
+MAP_HEAD = "MAP:MVA Germany {}\nFOLDER:MVA\nCOLOR:green\nSTYLE:Solid:1\n"
+
+def find_column(header, name, keyword=None):
     """
-    Read the CSV file and return a list of dictionaries
+    Find the index of a column in the CSV header
+    Falls back to the first column containing keyword (case-insensitive)
+    Returns None if no matching column exists
     """
-    data = []
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            print(f"CSV columns: {reader.fieldnames}")
-            for row in reader:
-                data.append(row)
-        print(f"Read {len(data)} rows from CSV.")
-    except Exception as e:
-        print(f"Error reading CSV file: {e}")
-        return []
-    
-    return data
+    if name in header:
+        return header.index(name)
+    if keyword:
+        for idx, col in enumerate(header):
+            if col and keyword in col.lower():
+                return idx
+    return None
 
-def parse_geometry(geometry_str):
+def iter_csv_rows(file_path):
     """
-    Parse WKT geometry string and extract coordinates
-    Format: POLYGON((lon1 lat1, lon2 lat2, ...))
-    Returns a list of [lat, lon] pairs
+    Read the CSV file lazily and yield one (geometry, LOWERLIMIT, MRVA_COLD)
+    tuple per row
+    Column indices are resolved once from the header, missing values are ''
+    Read errors are not caught here, they are raised to the caller
     """
-    if not geometry_str or not isinstance(geometry_str, str):
-        return []
-    
-    try:
-        # Check for POLYGON format
-        poly_match = re.search(r'POLYGON\s*\(\((.*?)\)\)', geometry_str)
-        if poly_match:
-            coord_str = poly_match.group(1)
-        else:
-            # Try other format with double parentheses
-            other_match = re.search(r'\(\((.*?)\)\)', geometry_str)
-            if other_match:
-                coord_str = other_match.group(1)
-            else:
-                return []
-        
-        pairs = coord_str.split(',')
-        
-        coords = []
-        for pair in pairs:
-            parts = pair.strip().split()
-            if len(parts) >= 2:
-                try:
-                    lon = float(parts[0])
-                    lat = float(parts[1])
-                    if -180 <= lon <= 180 and -90 <= lat <= 90:  # Basic validation
-                        coords.append([lat, lon])
-                except (ValueError, IndexError):
-                    continue
-        
-        # Need at least 3 points to form a polygon
-        if len(coords) < 3:
-            return []
+    count = 0
+    with open(file_path, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            return
+        print(f"CSV columns: {header}")
+
+        indices = (
+            find_column(header, '_geometry', keyword='geometry'),
+            find_column(header, 'LOWERLIMIT'),
+            find_column(header, 'MRVA_COLD'),
+        )
+        # Rows holding every column are read with a single itemgetter call,
+        # short rows and missing columns are padded with ''
+        get_fields = None
+        if None not in indices:
+            get_fields = itemgetter(*indices)
+            min_size = max(indices) + 1
         
-        return coords
-    
-    except Exception as e:
-        print(f"Error parsing geometry: {e}")
-        return []
+        for row in reader:
+            count += 1
+            size = len(row)
+            if get_fields is not None and size >= min_size:
+                yield get_fields(row)
+            else:
+                yield tuple(row[idx] if idx is not None and idx < size else '' for idx in indices)
 
-def decimal_to_dms(decimal_deg, is_latitude=True):
-    """
-    Convert decimal degrees to Topsky DMS format
-    Returns a string in the format "N/S/E/W DDD.MM.SS.000"
-    """
-    is_negative = decimal_deg < 0
-    decimal_deg = abs(decimal_deg)
-    
-    degrees = math.floor(decimal_deg)
-    decimal_minutes = (decimal_deg - degrees) * 60
-    minutes = math.floor(decimal_minutes)
-    decimal_seconds = (decimal_minutes - minutes) * 60
-    seconds = round(decimal_seconds)  # Round to nearest second
-    
-    # Handle rounding issues
-    if seconds == 60:
-        seconds = 0
-        minutes += 1
-    if minutes == 60:
-        minutes = 0
-        degrees += 1
-    
-    # Format direction prefix
-    if is_latitude:
-        prefix = 'S' if is_negative else 'N'
-    else:
-        prefix = 'W' if is_negative else 'E'
-    
-    # Format to exactly match the Topsky format (including leading zeros)
-    return f"{prefix}{degrees:03d}.{minutes:02d}.{seconds:02d}.000"
+    print(f"Read {count} rows from CSV.")
 
 def format_altitude(altitude):
     """
@@ -150,35 +119,6 @@ def format_altitude(altitude):
         print(f"Error formatting altitude '{altitude}': {e}")
         return None
 
-def generate_line_entries(polygons):
-    """
-    Generate LINE entries from polygons
-    Each polygon is a list of [lat, lon] coordinates
-    """
-    line_entries = []
-    
-    for polygon in polygons:
-        coords = polygon['coords']
-        if not coords or len(coords) < 3:
-            continue
-        
-        # Connect each point to the next, including last to first to close the polygon
-        for i in range(len(coords)):
-            lat1, lon1 = coords[i]
-            lat2, lon2 = coords[(i + 1) % len(coords)]
-            
-            # Format coordinates in Topsky format
-            lat1_str = decimal_to_dms(lat1, is_latitude=True)
-            lon1_str = decimal_to_dms(lon1, is_latitude=False)
-            lat2_str = decimal_to_dms(lat2, is_latitude=True)
-            lon2_str = decimal_to_dms(lon2, is_latitude=False)
-            
-            # Create LINE entry
-            line = f"LINE:{lat1_str}:{lon1_str}:{lat2_str}:{lon2_str}"
-            line_entries.append(line)
-    
-    return line_entries
-
 def calculate_centroid(coords):
     """
     Calculate the centroid of a polygon
@@ -189,6 +129,12 @@ def calculate_centroid(coords):
         return None
     
     try:
+        centroid = shoelace_centroid(coords)
+        
+        # Check if centroid is inside the polygon
+        if centroid and point_in_polygon(coords, centroid[0], centroid[1]):
+            return centroid
+        
         if SHAPELY_AVAILABLE:
             # Convert to shapely polygon (swap lat/lon order for shapely)
             polygon = Polygon([(lon, lat) for lat, lon in coords])
@@ -198,16 +144,13 @@ def calculate_centroid(coords):
             if polygon.is_empty:
                 return None
             
-            # Get the centroid point
-            centroid = polygon.centroid
-            
-            # Check if centroid is inside the polygon
-            if polygon.contains(centroid):
-                return [centroid.y, centroid.x]  # Return as [lat, lon]
+            # Polygons without area still get a centroid from Shapely
+            if not centroid:
+                centroid = [polygon.centroid.y, polygon.centroid.x]
             
             # Fallback: move the centroid step by step towards a guaranteed inside point
             inside = polygon.representative_point()
-            test_point = centroid
+            test_point = Point(centroid[1], centroid[0])
             for i in range(10):  # max 10 iterations
                 midx = (test_point.x + inside.x) / 2
                 midy = (test_point.y + inside.y) / 2
@@ -217,8 +160,10 @@ def calculate_centroid(coords):
 
             # If everything fails, just return representative_point
             return [inside.y, inside.x]
+        elif centroid:
+            return centroid
         else:
-            # Fall back to simple centroid calculation if Shapely is not available
+            # Fall back to simple centroid calculation for polygons without area
             lat_sum = sum(c[0] for c in coords)
             lon_sum = sum(c[1] for c in coords)
             return [lat_sum / len(coords), lon_sum / len(coords)]
@@ -230,188 +175,160 @@ def calculate_centroid(coords):
         lon_sum = sum(c[1] for c in coords)
         return [lat_sum / len(coords), lon_sum / len(coords)]
 
-def generate_text_entries(polygons):
+def generate_map_lines(polygons):
     """
-    Generate TEXT entries from polygons
-    Each polygon has a 'coords' list of [lat, lon] and an 'altitude' value
+    Generate the LINE entries of all polygons
+    Each polygon has a 'coords' list of [lat, lon]
+    The lines only depend on the geometry, so the summer and winter maps
+    share them
+    Returns the entries joined into one string and their number
     """
-    text_entries = []
-    
+    seen = set()
+    entries = []
     for polygon in polygons:
-        coords = polygon['coords']
-        altitude = polygon['altitude']
-        
-        if not coords or len(coords) < 3:
-            continue
-        
-        # Calculate centroid for text placement
-        centroid = calculate_centroid(coords)
-        if not centroid:
-            continue
-        
-        # Format coordinates
-        lat_str = decimal_to_dms(centroid[0], is_latitude=True)
-        lon_str = decimal_to_dms(centroid[1], is_latitude=False)
-        
-        # Format altitude to ensure it's exactly 2 digits
-        alt_str = format_altitude(altitude)
-        if not alt_str:
-            continue
-        
-        # Create TEXT entry
-        text = f"TEXT:{lat_str}:{lon_str}:{alt_str}"
-        text_entries.append(text)
+        entries.extend(polygon_line_entries(polygon['coords'], seen))
     
-    return text_entries
+    return "".join(entries), len(entries)
+
+def generate_label_positions(polygons):
+    """
+    Generate the Topsky position of each polygon's TEXT label
+    Each polygon has a 'coords' list of [lat, lon]
+    Returns one "lat:lon" DMS string per polygon, None where no centroid exists
+    """
+    # Calculate centroids for text placement
+    centroids = [calculate_centroid(polygon['coords']) for polygon in polygons]
+    
+    return [
+        f"{decimal_to_dms(centroid[0], is_latitude=True)}:{decimal_to_dms(centroid[1], is_latitude=False)}"
+        if centroid else None
+        for centroid in centroids
+    ]
+
+def generate_map_texts(polygons, positions, altitude_key):
+    """
+    Generate the TEXT entries of one map
+    positions come from generate_label_positions, altitude_key names the
+    polygon value ('warm_altitude' or 'cold_altitude') already formatted for Topsky
+    Returns the entries joined into one string and their number
+    """
+    entries = [
+        f"TEXT:{position}:{polygon[altitude_key]}\n"
+        for polygon, position in zip(polygons, positions)
+        if position and polygon[altitude_key]
+    ]
+    
+    return "".join(entries), len(entries)
 
 def convert_csv_to_topsky(csv_file, output_file, topsky_maps="both", head="true"):
     """
     Convert MVA CSV file to Topsky format with both Summer and Winter maps
     topsky_maps: "both" (default), "summer", or "winter"
     """
-    # Read CSV data
-    data = read_csv_file(csv_file)
-    if not data:
-        print("No data found in CSV file")
-        return False
-    
-    # Process data into polygons for both warm and cold MVAs
-    warm_polygons = []
-    cold_polygons = []
-    
-    # Count of successfully processed rows for each map
-    warm_count = 0
-    cold_count = 0
+    # Process data into polygons, shared by the warm and cold MVAs
+    polygons = []
     
-    for i, row in enumerate(data):
-        # Find geometry column (should be "_geometry")
-        geometry_col = '_geometry'
-        if geometry_col not in row:
-            for col in row:
-                if col and 'geometry' in col.lower():
-                    geometry_col = col
-                    break
-        
-        if geometry_col not in row or not row[geometry_col]:
-            continue
+    # Rows are streamed from the CSV, only the parsed polygons are kept
+    has_rows = False
+    try:
+        for i, (geometry, warm_alt, cold_alt) in enumerate(iter_csv_rows(csv_file)):
+            has_rows = True
+
+            if not geometry:
+                continue
         
-        # Debug information
-        if i < 5:  # Print first 5 rows for debugging
-            print(f"Row {i+1} geometry: {row[geometry_col][:50]}...")  # Truncate for readability
-            
-            warm_val = row.get('LOWERLIMIT', '')
-            cold_val = row.get('MRVA_COLD', '')
+            # Debug information
+            if i < 5:  # Print first 5 rows for debugging
+                print(f"Row {i+1} geometry: {geometry[:50]}...")  # Truncate for readability
             
-            print(f"Row {i+1} LOWERLIMIT: '{warm_val}' ({type(warm_val).__name__})")
-            print(f"Row {i+1} MRVA_COLD: '{cold_val}' ({type(cold_val).__name__})")
+                print(f"Row {i+1} LOWERLIMIT: '{warm_alt}' ({type(warm_alt).__name__})")
+                print(f"Row {i+1} MRVA_COLD: '{cold_alt}' ({type(cold_alt).__name__})")
             
-            warm_fmt = format_altitude(warm_val)
-            cold_fmt = format_altitude(cold_val)
-            
-            print(f"Row {i+1} Formatted LOWERLIMIT: '{warm_fmt}'")
-            print(f"Row {i+1} Formatted MRVA_COLD: '{cold_fmt}'")
-        
-        # Parse geometry
-        coords = parse_geometry(row[geometry_col])
-        if not coords or len(coords) < 3:
-            continue
+                print(f"Row {i+1} Formatted LOWERLIMIT: '{format_altitude(warm_alt)}'")
+                print(f"Row {i+1} Formatted MRVA_COLD: '{format_altitude(cold_alt)}'")
         
-        # Get altitude values directly from row dictionary
-        warm_alt = row.get('LOWERLIMIT', '')
-        cold_alt = row.get('MRVA_COLD', '')
+            # Parse geometry
+            coords = parse_geometry(geometry)
+            if not coords or len(coords) < 3:
+                continue
         
-        # Format altitude values for Topsky display
-        warm_alt_fmt = format_altitude(warm_alt)
-        cold_alt_fmt = format_altitude(cold_alt)
+            # Format altitude values for Topsky display, once per polygon
+            warm_alt_fmt = format_altitude(warm_alt)
+            cold_alt_fmt = format_altitude(cold_alt)
         
-        # Use warm_alt as fallback for cold_alt and vice versa
-        if warm_alt_fmt and not cold_alt_fmt:
-            cold_alt_fmt = warm_alt_fmt
-            cold_alt = warm_alt
-        elif cold_alt_fmt and not warm_alt_fmt:
-            warm_alt_fmt = cold_alt_fmt
-            warm_alt = cold_alt
+            # Use warm_alt as fallback for cold_alt and vice versa
+            if warm_alt_fmt and not cold_alt_fmt:
+                cold_alt_fmt = warm_alt_fmt
+            elif cold_alt_fmt and not warm_alt_fmt:
+                warm_alt_fmt = cold_alt_fmt
         
-        # Skip if neither altitude is available after formatting
-        if not warm_alt_fmt and not cold_alt_fmt:
-            # Try to assign a default value if none is available
-            warm_alt_fmt = "30"  # Default altitude if none specified
-            cold_alt_fmt = "30"  # Default altitude if none specified
-            warm_alt = "30"
-            cold_alt = "30"
+            # Skip if neither altitude is available after formatting
+            if not warm_alt_fmt and not cold_alt_fmt:
+                # Try to assign a default value if none is available
+                warm_alt_fmt = "30"  # Default altitude if none specified
+                cold_alt_fmt = "30"  # Default altitude if none specified
         
-        # Add to warm polygons
-        warm_polygons.append({
-            'coords': coords,
-            'altitude': warm_alt
-        })
-        warm_count += 1
-        
-        # Add to cold polygons
-        cold_polygons.append({
-            'coords': coords,
-            'altitude': cold_alt
-        })
-        cold_count += 1
+            # Add to polygons with the altitude for each map
+            polygons.append({
+                'coords': coords,
+                'warm_altitude': warm_alt_fmt,
+                'cold_altitude': cold_alt_fmt
+            })
+    except Exception as e:
+        # Never write a map from a partly read file
+        print(f"Error reading CSV file: {e}")
+        has_rows = False
+    
+    if not has_rows:
+        print("No data found in CSV file")
+        return False
     
-    print(f"Processed {warm_count} polygons for summer MVA")
-    print(f"Processed {cold_count} polygons for winter MVA")
+    print(f"Processed {len(polygons)} polygons for summer MVA")
+    print(f"Processed {len(polygons)} polygons for winter MVA")
     
     # Write to output file
     try:
         # initialize to avoid reference errors
-        warm_lines, warm_texts, cold_lines, cold_texts = [], [], [], []
-        with open(output_file, 'w') as f:
+        warm_lines, warm_texts, cold_lines, cold_texts = 0, 0, 0, 0
+        with open(output_file, 'w', buffering=WRITE_BUFFER_SIZE, encoding='utf-8', newline='\n') as f:
+            # LINE entries and label positions are generated once for both maps
+            lines, line_count = generate_map_lines(polygons)
+            positions = generate_label_positions(polygons)
+            
             if topsky_maps in ("both", "summer"):
-                # Generate LINE and TEXT entries for warm MVA
-                warm_lines = generate_line_entries(warm_polygons)
-                warm_texts = generate_text_entries(warm_polygons)
-
-                print(f"Generated {len(warm_lines)} lines and {len(warm_texts)} texts for summer MVA")
                 if str(head).lower() == "true":
                     # Write Summer (Warm) MVA map
-                    f.write("MAP:MVA Germany Summer\n")
-                    f.write("FOLDER:MVA\n")
-                    f.write("COLOR:green\n")
-                    f.write("STYLE:Solid:1\n")
+                    f.write(MAP_HEAD.format("Summer"))
 
-                # Write all LINE entries for warm MVA
-                for line in warm_lines:
-                    f.write(f"{line}\n")
+                # Write all LINE and TEXT entries for warm MVA
+                texts, warm_texts = generate_map_texts(polygons, positions, 'warm_altitude')
+                f.write(lines)
+                f.write(texts)
+                warm_lines = line_count
 
-                # Write all TEXT entries for warm MVA
-                for text in warm_texts:
-                    f.write(f"{text}\n")
+                print(f"Generated {warm_lines} lines and {warm_texts} texts for summer MVA")
                     
             if topsky_maps == "both":
                 # Add a blank line between maps
                 f.write("\n")
             
             if topsky_maps in ("both", "winter"):
-                # Generate LINE and TEXT entries for cold MVA
-                cold_lines = generate_line_entries(cold_polygons)
-                cold_texts = generate_text_entries(cold_polygons)
-                
-                print(f"Generated {len(cold_lines)} lines and {len(cold_texts)} texts for winter MVA")
                 # Write Winter (Cold) MVA map
                 if str(head).lower() == "true":
-                    f.write("MAP:MVA Germany Winter\n")
-                    f.write("FOLDER:MVA\n")
-                    f.write("COLOR:green\n")
-                    f.write("STYLE:Solid:1\n")
+                    f.write(MAP_HEAD.format("Winter"))
 
-                # Write all LINE entries for cold MVA
-                for line in cold_lines:
-                    f.write(f"{line}\n")
+                # Write all LINE and TEXT entries for cold MVA
+                texts, cold_texts = generate_map_texts(polygons, positions, 'cold_altitude')
+                f.write(lines)
+                f.write(texts)
+                cold_lines = line_count
 
-                # Write all TEXT entries for cold MVA
-                for text in cold_texts:
-                    f.write(f"{text}\n")
+                print(f"Generated {cold_lines} lines and {cold_texts} texts for winter MVA")
         
         if topsky_maps in ("both", "summer"):
-            print(f"Summer Map: {len(warm_lines)} LINE entries and {len(warm_texts)} TEXT entries")
+            print(f"Summer Map: {warm_lines} LINE entries and {warm_texts} TEXT entries")
         if topsky_maps in ("both", "winter"):
-            print(f"Winter Map: {len(cold_lines)} LINE entries and {len(cold_texts)} TEXT entries")
+            print(f"Winter Map: {cold_lines} LINE entries and {cold_texts} TEXT entries")
             
         if topsky_maps == "both":
             print(f"Successfully wrote both MVA maps in {output_file}")